@@ -41,20 +41,20 @@ python server.py --testall
 
 import os
 import re
+import asyncio
 import sys
 import json
-import base64
 import requests
 
 from datetime import datetime
 
 from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse
-
-from openai import OpenAI
+from fastapi.responses import ORJSONResponse
 
 import uvicorn
 
+from mcq_core import b64encode_as_string, image_mime, make_async_client
+
 
 # ─────────────────────────────────────────────
 # CONFIG
@@ -70,13 +70,33 @@ MAX_TOKENS = 1200          # v5 was 500 — too small for puzzles
 
 LOG_DIR = "logs"
 
+# Images above this go up once via the Files API and are referenced by file_id,
+# instead of riding inside the request as a data URL (+33% base64 bloat).
+# The upload costs one extra round trip; at the 2 MB default the ~0.7 MB of base64
+# it saves is already worth about that, and 3-5 MB phone photos take this path.
+# Tune per deployment with FILE_UPLOAD_THRESHOLD_KB (0 sends every image as a file).
+FILE_UPLOAD_THRESHOLD = int(os.environ.get("FILE_UPLOAD_THRESHOLD_KB", "2048")) * 1024
+
 FAIL_LOG = os.path.join(LOG_DIR, "failures.txt")
 
 os.makedirs(LOG_DIR, exist_ok=True)
 
-app = FastAPI(title="Exam Solver API v6.0", version="6.0")
+app = FastAPI(title="Exam Solver API v6.0", version="6.0", default_response_class=ORJSONResponse)
+
+_client = None
+
 
-client = OpenAI(api_key=API_KEY)
+def get_client():
+    """
+    Build the OpenAI client on first use.
+    openai/httpx add noticeable import time, and the CLI test modes
+    (--test / --manual) never need them.
+    """
+    global _client
+    if _client is None:
+        # pooled HTTP/2 connections (see mcq_core.make_async_client); openai is imported there
+        _client = make_async_client(API_KEY, None, max_connections=200, max_keepalive=100)
+    return _client
 
 
 # ─────────────────────────────────────────────
@@ -94,10 +114,29 @@ WEB_SEARCH_TOOL = {"type": "web_search_preview"}
 # HELPERS
 # ─────────────────────────────────────────────
 
+_QID_RE       = re.compile(r'\d+')
+_CTRL_RE      = re.compile(r'[\x00-\x1f\x7f]')
+_SPACES_RE    = re.compile(r' {2,}')
+_BLANKLINE_RE = re.compile(r'\n{3,}')
+
+OCR_REPLACEMENTS = {
+    "0S":     "OS",
+    "HTIP":   "HTTP",
+    "RBl":    "RBI",
+    "UP1":    "UPI",
+    "prfit":  "profit",
+    "invst":  "invest",
+    "gih":    "Gita",
+    "lndia":  "India",
+    "ﬁ":      "fi",
+    "ﬂ":      "fl",
+}
+
+
 def clean_qid(qid: str) -> str:
     try:
         qid = str(qid).strip()
-        m = re.search(r'\d+', qid)
+        m = _QID_RE.search(qid)
         return "Q" + m.group() if m else "Q1"
     except:
         return "Q1"
@@ -109,25 +148,12 @@ def clean_text(text: str) -> str:
     text = text.replace("\r\n", "\n")
     text = text.replace("\r", "\n")
 
-    replacements = {
-        "0S":     "OS",
-        "HTIP":   "HTTP",
-        "RBl":    "RBI",
-        "UP1":    "UPI",
-        "prfit":  "profit",
-        "invst":  "invest",
-        "gih":    "Gita",
-        "lndia":  "India",
-        "ﬁ":      "fi",
-        "ﬂ":      "fl",
-    }
-
-    for k, v in replacements.items():
+    for k, v in OCR_REPLACEMENTS.items():
         text = text.replace(k, v)
 
-    text = re.sub(r'[\x00-\x1f\x7f]', '', text)
-    text = re.sub(r' {2,}', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = _CTRL_RE.sub('', text)
+    text = _SPACES_RE.sub(' ', text)
+    text = _BLANKLINE_RE.sub('\n\n', text)
 
     return text.strip()
 
@@ -303,11 +329,18 @@ STRICT RULES
 """
 
 
+# Shared by every request — built once at import
+SYSTEM_MSG = {
+    "role": "system",
+    "content": UNIVERSAL_PROMPT
+}
+
+
 # ─────────────────────────────────────────────
 # GPT CALLS
 # ─────────────────────────────────────────────
 
-def call_gpt_text(qid: str, raw: str):
+async def call_gpt_text(qid: str, raw: str):
 
     user_msg = f"""QID: {qid}
 
@@ -316,14 +349,11 @@ Question:
 
 Solve carefully. Use web search if this is current affairs, computer awareness, or banking awareness."""
 
-    resp = client.responses.create(
+    resp = await get_client().responses.create(
         model=MODEL,
         tools=[WEB_SEARCH_TOOL],
         input=[
-            {
-                "role": "system",
-                "content": UNIVERSAL_PROMPT
-            },
+            SYSTEM_MSG,
             {
                 "role": "user",
                 "content": user_msg
@@ -345,41 +375,66 @@ Solve carefully. Use web search if this is current affairs, computer awareness,
     }
 
 
-def call_gpt_image(qid: str, img_bytes: bytes, mime: str = "image/jpeg"):
+_DELETE_TASKS = set()  # keep references to in-flight file deletes
 
-    b64 = base64.b64encode(img_bytes).decode()
 
-    resp = client.responses.create(
-        model=MODEL,
-        tools=[WEB_SEARCH_TOOL],
-        input=[
-            {
-                "role": "system",
-                "content": UNIVERSAL_PROMPT
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "input_text",
-                        "text": f"""QID: {qid}
+async def _delete_file(client, file_id: str):
+    try:
+        await client.files.delete(file_id)
+    except Exception:
+        pass
+
+
+async def call_gpt_image(qid: str, img_bytes: bytes, mime: str = "image/jpeg"):
+
+    client = get_client()
+    file_id = None
+
+    if len(img_bytes) > FILE_UPLOAD_THRESHOLD:
+        uploaded = await client.files.create(
+            file=(f"{qid}.{mime.rsplit('/', 1)[-1]}", img_bytes, mime),
+            purpose="vision"
+        )
+        file_id = uploaded.id
+        image_part = {"type": "input_image", "file_id": file_id}
+    else:
+        image_part = {
+            "type": "input_image",
+            "image_url": f"data:{mime};base64,{b64encode_as_string(img_bytes)}"
+        }
+
+    try:
+        resp = await client.responses.create(
+            model=MODEL,
+            tools=[WEB_SEARCH_TOOL],
+            input=[
+                SYSTEM_MSG,
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "input_text",
+                            "text": f"""QID: {qid}
 
 Read the screenshot/image carefully.
 OCR may contain mistakes — auto-correct.
 If options are visible, return exact correct option.
 Use web search if this involves current affairs, computer awareness, or banking awareness.
 Solve accurately."""
-                    },
-                    {
-                        "type": "input_image",
-                        "image_url": f"data:{mime};base64,{b64}"
-                    }
-                ]
-            }
-        ],
-        max_output_tokens=MAX_TOKENS,
-        temperature=0
-    )
+                        },
+                        image_part
+                    ]
+                }
+            ],
+            max_output_tokens=MAX_TOKENS,
+            temperature=0
+        )
+    finally:
+        # vision uploads are single-use; delete after the reply is sent, not before
+        if file_id:
+            task = asyncio.create_task(_delete_file(client, file_id))
+            _DELETE_TASKS.add(task)
+            task.add_done_callback(_DELETE_TASKS.discard)
 
     ans = extract_output_text(resp)
 
@@ -398,12 +453,12 @@ Solve accurately."""
 
 @app.get("/health")
 def health():
-    return {
+    return ORJSONResponse({
         "status":     "ok",
         "model":      MODEL,
         "web_search": True,
         "version":    "6.0"
-    }
+    })
 
 
 @app.post("/solve-image")
@@ -414,12 +469,12 @@ async def solve_image(
     img_bytes = await image.read()
 
     if not img_bytes:
-        return JSONResponse({"error": "empty image"}, status_code=400)
+        return ORJSONResponse({"error": "empty image"}, status_code=400)
 
-    mime = image.content_type or "image/jpeg"
+    mime = image_mime(img_bytes[:12], image.content_type)
     qid  = clean_qid(qid)
 
-    return call_gpt_image(qid, img_bytes, mime)
+    return ORJSONResponse(await call_gpt_image(qid, img_bytes, mime))
 
 
 @app.post("/solve-text")
@@ -430,11 +485,11 @@ async def solve_text(
     text = clean_text(text)
 
     if not text:
-        return JSONResponse({"error": "empty text"}, status_code=400)
+        return ORJSONResponse({"error": "empty text"}, status_code=400)
 
     qid = clean_qid(qid)
 
-    return call_gpt_text(qid, text)
+    return ORJSONResponse(await call_gpt_text(qid, text))
 
 
 # ─────────────────────────────────────────────
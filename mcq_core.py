@@ -0,0 +1,390 @@
+# mcq_core.py
+# Pieces every solver entrypoint needs; imported once per process instead of
+# each app carrying its own copy.
+import io
+import os
+import time
+import shutil
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from pathlib import Path
+from threading import RLock
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+# pybase64 wraps libbase64's AVX2/AVX-512/NEON kernels (picked per-CPU at import);
+# stdlib base64 keeps the server running where no wheel is available
+try:
+    from pybase64 import b64encode, b64encode_as_string
+except ImportError:
+    from base64 import b64encode
+    def b64encode_as_string(data):
+        return b64encode(data).decode("ascii")
+
+# Pillow is optional for the lightweight servers; without it images are sent as uploaded
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# BLAKE3 (SIMD tree hash) keys the response caches; blake2b if it isn't installed
+try:
+    from blake3 import blake3 as content_hasher
+except ImportError:
+    from hashlib import blake2b as content_hasher
+
+
+# uploads are read in chunks; a multiple of 3 so each chunk base64-encodes without padding
+READ_CHUNK = 63 * 1024
+
+
+def b64_stream(fh, chunk_size: int = READ_CHUNK, update=None) -> str:
+    # base64 of a file object, encoded chunk by chunk so the raw bytes are never held whole;
+    # the 0-2 byte tail of each chunk is carried into the next one. update (e.g. a hash's
+    # .update) sees every raw chunk, so hashing shares the same read pass
+    out = bytearray()
+    rest = b""
+    for chunk in iter(lambda: fh.read(chunk_size), b""):
+        if update is not None:
+            update(chunk)
+        if rest:
+            chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        out += b64encode(chunk[:cut])
+        rest = chunk[cut:]
+    out += b64encode(rest)
+    return out.decode("ascii")
+
+
+_IMAGE_MIMES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+
+
+def image_mime(head: bytes, content_type=None) -> str:
+    # MIME for an image sent as uploaded: the client's content type when it is one the
+    # model accepts, else sniffed from the first 12 bytes; JPEG when nothing matches
+    if content_type in _IMAGE_MIMES:
+        return content_type
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+def content_key(fhs) -> bytes:
+    # BLAKE3 over every upload, read in READ_CHUNK blocks; each file is length-prefixed so
+    # [ab][c] and [a][bc] get different keys
+    h = content_hasher()
+    for fh in fhs:
+        fh.seek(0, 2)
+        h.update(fh.tell().to_bytes(8, "little"))
+        fh.seek(0)
+        for chunk in iter(lambda: fh.read(READ_CHUNK), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def try_parse_json_candidate(text: str):
+    # single parse: the whole reply if it is bare JSON, else the outermost {...} slice, so
+    # fenced (```json ... ```) or chatty replies still parse; find/rfind scan in C, no regex
+    candidate = text.strip()
+    if not (candidate.startswith('{') and candidate.endswith('}')):
+        start = candidate.find('{')
+        end = candidate.rfind('}')
+        if start == -1 or end <= start:
+            return None
+        candidate = candidate[start:end+1]
+    try:
+        j = orjson.loads(candidate)
+    except Exception:
+        return None
+    return j if isinstance(j, dict) else None
+
+
+def make_async_client(api_key: str, project_id=None, max_connections=100, max_keepalive=50):
+    # openai pulls in httpx/pydantic/anyio; callers decide when to pay for that import
+    import httpx
+    import openai
+    # one pooled HTTP/2 connection set for every request; bursts reuse warm TLS sessions
+    http_client = openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive, keepalive_expiry=60.0),
+    )
+    if project_id:
+        return openai.AsyncOpenAI(api_key=api_key, project=project_id, http_client=http_client)
+    return openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+
+# formats the model accepts as uploaded; anything else is always re-encoded to JPEG
+MODEL_FORMATS = {"JPEG", "PNG", "WEBP", "GIF"}
+
+
+def flatten_rgb(im):
+    # JPEG has no alpha: put transparent pixels on white, or black text on a clear PNG
+    # becomes a solid black page
+    if im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        bg = Image.new("RGB", im.size, (255, 255, 255))
+        bg.paste(im, mask=im.getchannel("A"))
+        return bg
+    return im.convert("RGB")
+
+
+def shrink_image(data, max_side: int = 1536, quality: int = 85, optimize: bool = False):
+    # phone photos are 3-8 MB; the model resizes to ~1024px anyway, so send it less.
+    # data may be bytes or a seekable buffer such as an mmap (read in place, not copied);
+    # it is returned as-is when no resize is needed.
+    if Image is None:
+        return data
+    try:
+        im = Image.open(data if hasattr(data, "seek") else io.BytesIO(data))
+        if im.format in MODEL_FORMATS and max(im.size) <= max_side:
+            return data  # already small enough; re-encoding would only lose quality
+        im.thumbnail((max_side, max_side))
+        buf = io.BytesIO()
+        flatten_rgb(im).save(buf, "JPEG", quality=quality, optimize=optimize)
+        return buf.getvalue()
+    except Exception:
+        return data  # not decodable by Pillow: send as uploaded
+
+
+def image_data_url(fh, content_type=None, **shrink) -> str:
+    # works on the spooled upload file; the raw image is never read into one bytes object.
+    # shrink is passed on to shrink_image (max_side, quality, optimize)
+    fh.seek(0)
+    data = shrink_image(fh, **shrink)  # re-encoded JPEG bytes, or fh itself when no resize was needed
+    if isinstance(data, bytes):
+        return "data:image/jpeg;base64," + b64encode_as_string(data)
+    fh.seek(0)
+    mime = image_mime(fh.read(12), content_type)  # sent as uploaded: label it with its real type
+    fh.seek(0)
+    return f"data:{mime};base64," + b64_stream(fh)
+
+
+# --- LRU helpers over a plain OrderedDict (oldest entry first) ---
+def lru_get(cache: OrderedDict, key):
+    hit = cache.get(key)
+    if hit is not None:
+        cache.move_to_end(key)
+    return hit
+
+def lru_put(cache: OrderedDict, key, value, size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+# --- Micro-batching: concurrent solves within `window` seconds share one model call ---
+class MicroBatcher:
+    """
+    complete(system_msg, content, questions) -> raw model reply. A batch of n questions is
+    sent as one call with batch_system_msg, each question under a "=== Q<i> ===" header, and
+    must come back as {"answers": [...]} in header order; otherwise each is asked on its own.
+    """
+
+    def __init__(self, complete, system_msg: dict, batch_system_msg: dict, user_part: dict,
+                 max_batch: int = 4, window: float = 0.05):
+        self.complete = complete
+        self.system_msg = system_msg
+        self.batch_system_msg = batch_system_msg
+        self.user_part = user_part
+        self.max_batch = max_batch   # 1 disables batching
+        self.window = window
+        self._queue = None   # asyncio.Queue of (imgs, future), created by start()
+        self._tasks = set()  # keep references to the batcher and in-flight batch calls
+
+    def start(self):
+        # call from a startup hook: the queue and task belong to the server's loop
+        if self.max_batch > 1:
+            self._queue = asyncio.Queue()
+            self._tasks.add(asyncio.create_task(self._run()))
+
+    async def ask(self, imgs: list) -> str:
+        # raw model reply for one question, sharing a call with concurrent requests when possible
+        if self._queue is None:
+            return await self.complete(self.system_msg, [self.user_part, *imgs], 1)
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((imgs, fut))
+        return await fut
+
+    async def _solve_one(self, imgs: list, fut):
+        try:
+            raw = await self.complete(self.system_msg, [self.user_part, *imgs], 1)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+            return
+        if not fut.done():  # caller may have disconnected
+            fut.set_result(raw)
+
+    async def _run_batch(self, batch: list):
+        if len(batch) == 1:
+            await self._solve_one(*batch[0])
+            return
+        content = [self.user_part]
+        for i, (imgs, _) in enumerate(batch, 1):
+            content.append({"type": "text", "text": f"=== Q{i} ==="})
+            content.extend(imgs)
+        answers = None
+        try:
+            parsed = try_parse_json_candidate(await self.complete(self.batch_system_msg, content, len(batch)))
+            if parsed and isinstance(parsed.get("answers"), list) and len(parsed["answers"]) == len(batch):
+                answers = parsed["answers"]
+        except Exception:
+            pass
+        if answers is None:
+            # model failed or broke the array contract: answer each question on its own
+            await asyncio.gather(*[self._solve_one(imgs, fut) for imgs, fut in batch])
+            return
+        for (_, fut), answer in zip(batch, answers):
+            if not fut.done():
+                fut.set_result(orjson.dumps(answer).decode())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # don't hold the next window hostage to this model call
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+# --- Upload task queues (server_queue, server_simple) ---
+@dataclass
+class TaskRecord:
+    status: str = "queued"   # queued | processing | done | failed | cancelled
+    result: Any = None
+    cancelled: bool = False
+    bucket: str = ""         # YYYYMMDD upload dir under the store's root
+    future: Any = None       # running call, so a cancel endpoint can abandon it
+    done_event: asyncio.Event = field(default_factory=asyncio.Event)  # set once status is final
+
+
+def upload_bucket() -> str:
+    return time.strftime("%Y%m%d")
+
+
+SSE_PING_SECONDS = 15  # comment line keeps proxies from closing an idle stream
+
+
+class TaskStore:
+    """
+    Task records, the bounded work queue and the upload dirs (root/<YYYYMMDD>/<task_id>/).
+    One record per task; the lock makes each status+result change atomic, including for
+    routes FastAPI runs in its threadpool.
+    """
+
+    def __init__(self, root: Path, max_queue: int):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.tasks: Dict[str, TaskRecord] = {}
+        self.lock = RLock()
+        self.queue = asyncio.Queue(maxsize=max_queue)  # bounded: a flood gets 503s, not an OOM
+
+    def task_dir(self, task_id: str, bucket: Optional[str] = None) -> Path:
+        if bucket is None:
+            rec = self.tasks.get(task_id)
+            bucket = rec.bucket if rec is not None else ""
+        return self.root / bucket / task_id
+
+    def save_uploads(self, task_id: str, bucket: str, files) -> List[str]:
+        dest = self.task_dir(task_id, bucket)
+        dest.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for i, f in enumerate(files):
+            ext = Path(f.filename).suffix or ".jpg"
+            target = dest / f"img_{i}{ext}"
+            with target.open("wb") as fh:
+                # stream from the spooled upload in 1 MB chunks; never hold the whole image
+                shutil.copyfileobj(f.file, fh, length=1 << 20)
+            paths.append(str(target))
+        return paths
+
+    async def submit(self, task_id: str, files, **fields) -> bool:
+        # False when the queue is full, before or after saving (nothing is left on disk);
+        # disk errors propagate to the caller
+        if self.queue.full():
+            return False
+        bucket = upload_bucket()
+        # disk writes happen off the event loop
+        paths = await asyncio.to_thread(self.save_uploads, task_id, bucket, files)
+        self.tasks[task_id] = TaskRecord(bucket=bucket)
+        try:
+            self.queue.put_nowait({"task_id": task_id, "image_paths": paths, **fields})
+        except asyncio.QueueFull:
+            # filled up while this upload was being saved
+            self.tasks.pop(task_id, None)
+            shutil.rmtree(self.task_dir(task_id, bucket), ignore_errors=True)
+            return False
+        return True
+
+    def finish(self, rec: TaskRecord, status: str, result) -> bool:
+        # True if this call settled the task; the caller then makes the one result.json write
+        with self.lock:
+            if rec.cancelled:
+                return False  # a cancel already settled this task
+            rec.status = status
+            rec.result = result
+            rec.future = None
+        rec.done_event.set()
+        return True
+
+    def write_result(self, task_id: str, payload: dict):
+        p = self.task_dir(task_id) / "result.json"
+        tmp = p.with_suffix(".json.tmp")
+        try:
+            # atomic replace
+            tmp.write_bytes(orjson.dumps(payload))
+            os.replace(tmp, p)
+        except Exception:
+            pass
+
+    def read_result(self, task_id: str):
+        p = self.task_dir(task_id) / "result.json"
+        if p.exists():
+            try:
+                return orjson.loads(p.read_bytes())
+            except Exception:
+                return None
+        return None
+
+    async def result_events(self, task_id: str, rec: TaskRecord):
+        # Server-Sent Events body: pings while the task runs, then one event with the final state
+        while not rec.done_event.is_set():
+            try:
+                await asyncio.wait_for(rec.done_event.wait(), SSE_PING_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+        with self.lock:
+            payload = {"task_id": task_id, "status": rec.status, "result": rec.result}
+        yield b"data: " + orjson.dumps(payload) + b"\n\n"
+
+    def remove_old_buckets(self, days: int):
+        cutoff = (date.today() - timedelta(days=days)).strftime("%Y%m%d")
+        cutoff_ts = time.time() - days * 86400
+        removed = []
+        for d in self.root.iterdir():
+            try:
+                # day buckets compare as strings; anything else is a pre-bucket task dir, judged by mtime
+                if d.is_dir() and (d.name < cutoff if d.name.isdigit() else d.stat().st_mtime < cutoff_ts):
+                    shutil.rmtree(d)
+                    removed.append(d.name)
+            except Exception:
+                pass
+        print(f"cleanup_older: removed {removed}")
@@ -1,22 +1,71 @@
 # sample.py
 import os
 import re
-import json
-import base64
+import time
+import asyncio
+from collections import OrderedDict
+from hashlib import sha256
 from typing import List, Optional
 
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-import openai
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse
 
-app = FastAPI(title="Multi-Image MCQ Solver")
+from mcq_core import READ_CHUNK, b64_stream, b64encode_as_string, image_mime, shrink_image, make_async_client, lru_get, lru_put, try_parse_json_candidate, MicroBatcher
+
+app = FastAPI(title="Multi-Image MCQ Solver", default_response_class=ORJSONResponse)
 
 # --- OpenAI client init (project-scoped optional) ---
 API_KEY = os.getenv("OPENAI_API_KEY")
 PROJECT_ID = os.getenv("OPENAI_PROJECT_ID")
-client = None
-if API_KEY:
-    client = openai.OpenAI(api_key=API_KEY, project=PROJECT_ID) if PROJECT_ID else openai.OpenAI(api_key=API_KEY)
+_client = None
+
+def get_client():
+    # openai pulls in httpx/pydantic/anyio; import it on first /solve, not at worker boot
+    global _client
+    if _client is None and API_KEY:
+        _client = make_async_client(API_KEY, PROJECT_ID, max_connections=200, max_keepalive=100)
+    return _client
+
+# --- Precompiled patterns used on every request ---
+_Q_RE = re.compile(r'[qQ][\-_ ]?(\d{1,3})')
+_NUM_RE = re.compile(r'(\d+)')
+_LETTER_RE = re.compile(r'\b([A-E])\b', re.IGNORECASE)
+
+# --- Response cache: identical uploads skip the model round-trip ---
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "512"))
+_CACHE = OrderedDict()  # (sha256 of per-image digests, qnum) -> response dict, LRU order
+
+def _cache_get(key):
+    return lru_get(_CACHE, key)
+
+def _cache_put(key, out: dict):
+    # only remember real answers; unclear/confused results deserve a retry
+    if not out.get("correct_option"):
+        return
+    lru_put(_CACHE, key, out, CACHE_SIZE)
+
+# --- Idempotency: a retry carrying the same Idempotency-Key gets the stored answer ---
+IDEMPOTENCY_TTL = 600   # seconds
+IDEMPOTENCY_SIZE = 4096
+_IDEMP_CACHE = OrderedDict()  # key -> (expires_at, response dict), oldest first
+
+def _idemp_get(key):
+    hit = _IDEMP_CACHE.get(key)
+    if hit is None:
+        return None
+    if hit[0] < time.monotonic():
+        del _IDEMP_CACHE[key]
+        return None
+    return hit[1]
+
+def _idemp_put(key, out: dict):
+    if not key or not out.get("correct_option"):
+        return
+    _IDEMP_CACHE[key] = (time.monotonic() + IDEMPOTENCY_TTL, out)
+    _IDEMP_CACHE.move_to_end(key)
+    # fixed TTL keeps insertion order == expiry order
+    while len(_IDEMP_CACHE) > IDEMPOTENCY_SIZE:
+        _IDEMP_CACHE.popitem(last=False)
 
 # --- Morse map for A-E (server provides this in response) ---
 MORSE_MAP = {
@@ -48,9 +97,32 @@ Rules (follow exactly):
 7) Do NOT include any other fields or non-JSON text.
 """
 
-@app.get("/", response_class=JSONResponse)
+USER_TEXT = (
+    "These images together form a single MCQ (question + options). "
+    "Read all images carefully, perform calculations if needed, and respond with EXACT JSON matching the schema in the system prompt. "
+    "The first uploaded filename may contain the question number; if present, use it. "
+    "Respond only with the required JSON."
+)
+
+# Appended to the system prompt when several queued /solve calls share one request
+BATCH_PROMPT = """
+BATCH MODE: this request contains several independent MCQs. Each starts with a "=== Q<n> ===" header followed by its images.
+Solve each one separately using the schema above and return ONLY JSON of the form:
+{"answers": [<schema object for Q1>, <schema object for Q2>, ...]}
+with exactly one object per question, in header order.
+"""
+
+_SYSTEM_MSG = {"role":"system", "content": SYSTEM_PROMPT}
+_BATCH_SYSTEM_MSG = {"role":"system", "content": SYSTEM_PROMPT + BATCH_PROMPT}
+_USER_PART = {"type":"text","text": USER_TEXT}
+
+# --- Micro-batching: concurrent /solve calls within BATCH_WINDOW_MS share one model call ---
+MAX_BATCH = int(os.getenv("MAX_BATCH", "4"))   # 1 disables batching
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW_MS", "50")) / 1000
+
+@app.get("/", response_class=ORJSONResponse)
 def root():
-    return {"message": "Multi-image MCQ solver active"}
+    return ORJSONResponse({"message": "Multi-image MCQ solver active"})
 
 @app.get("/test", response_class=HTMLResponse)
 def test_page():
@@ -92,13 +164,15 @@ def test_page():
 def extract_question_number_from_filename(filename: Optional[str]):
     if not filename:
         return None
-    m = re.search(r'[qQ][\-_ ]?(\d{1,3})', filename)
-    if m:
-        try:
-            return int(m.group(1))
-        except:
-            pass
-    all_nums = re.findall(r'(\d+)', filename)
+    # plain substring test is far cheaper than the regex and most names have no q
+    if 'q' in filename or 'Q' in filename:
+        m = _Q_RE.search(filename)
+        if m:
+            try:
+                return int(m.group(1))
+            except:
+                pass
+    all_nums = _NUM_RE.findall(filename)
     for num in all_nums:
         try:
             n = int(num)
@@ -108,25 +182,6 @@ def extract_question_number_from_filename(filename: Optional[str]):
             return n
     return None
 
-def try_parse_json_candidate(text: str):
-    try:
-        j = json.loads(text)
-        if isinstance(j, dict):
-            return j
-    except Exception:
-        pass
-    start = text.find('{')
-    end = text.rfind('}')
-    if start != -1 and end != -1 and end > start:
-        candidate = text[start:end+1]
-        try:
-            j = json.loads(candidate)
-            if isinstance(j, dict):
-                return j
-        except Exception:
-            pass
-    return None
-
 def sanitize_and_build_response(parsed: dict, qnum: Optional[int], total_images: int):
     # default shape
     out = {
@@ -142,24 +197,96 @@ def sanitize_and_build_response(parsed: dict, qnum: Optional[int], total_images:
     status = parsed.get("status")
     if status in ("ok","unclear","confused"):
         out["status"] = status
-    if parsed.get("correct_option") and isinstance(parsed.get("correct_option"), str):
-        opt = parsed.get("correct_option").strip().upper()
-        if opt in ("A","B","C","D","E"):
+    opt = parsed.get("correct_option")
+    if opt and isinstance(opt, str):
+        # JSON mode replies are already "B"; only normalize when they aren't
+        if opt not in MORSE_MAP:
+            opt = opt.strip().upper()
+        if opt in MORSE_MAP:
             out["correct_option"] = opt
-            out["morse"] = MORSE_MAP.get(opt)  # attach morse string
-    if parsed.get("morse") and isinstance(parsed.get("morse"), str) and out["morse"] is None:
+            out["morse"] = MORSE_MAP[opt]  # attach morse string
+    morse = parsed.get("morse")
+    if morse and isinstance(morse, str) and out["morse"] is None:
         # if model itself provided morse, accept it (but still prefer canonical map)
-        out["morse"] = parsed.get("morse").strip()
-    if parsed.get("explanation"):
-        out["explanation"] = str(parsed.get("explanation"))[:200]
+        out["morse"] = morse.strip()
+    explanation = parsed.get("explanation")
+    if explanation:
+        out["explanation"] = str(explanation)[:200]
     return out
 
 def fallback_extract_letter(text: str):
-    m = re.search(r'\b([A-E])\b', text, re.IGNORECASE)
+    # model obeyed and replied with a bare letter ("B", "B.", "B) ..."): no regex needed
+    s = text.lstrip()
+    if s and s[0].upper() in "ABCDE" and (len(s) == 1 or not s[1].isalnum()):
+        return s[0].upper()
+    m = _LETTER_RE.search(text)
     return m.group(1).upper() if m else None
 
-@app.post("/solve")
-async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(None)):
+# Phone photos are often 4-12 MB; the model only needs ~1600px for OCR
+SHRINK_THRESHOLD = 400_000   # bytes; smaller uploads are sent untouched
+SHRINK_MAX_SIDE = 1600
+
+def _image_part(mime: str, b64: str):
+    return {"type": "image_url", "image_url": {"url": f"data:{mime};base64," + b64}}
+
+def _encode_file(fh):
+    fh.seek(0, 2)
+    size = fh.tell()
+    fh.seek(0)
+    h = sha256()
+
+    if size >= SHRINK_THRESHOLD:
+        # cache key stays on the original bytes; only the payload is recompressed
+        for chunk in iter(lambda: fh.read(READ_CHUNK), b""):
+            h.update(chunk)
+        fh.seek(0)
+        small = shrink_image(fh, SHRINK_MAX_SIDE)  # fh itself when small or not decodable
+        if isinstance(small, bytes):
+            return h.digest(), _image_part("image/jpeg", b64encode_as_string(small))
+        # send it as uploaded
+        fh.seek(0)
+        h = sha256()
+
+    # stream the upload through sha256 + base64 so the raw bytes are never held whole
+    mime = image_mime(fh.read(12))
+    fh.seek(0)
+    b64 = b64_stream(fh, update=h.update)
+    return h.digest(), _image_part(mime, b64)
+
+async def _encode(f: UploadFile):
+    # read + hash + shrink/encode is CPU-bound per file: run it on the default executor
+    # so large images don't stall other requests, and files encode in parallel
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _encode_file, f.file)
+
+async def _complete(system_msg: dict, content: list, questions: int = 1) -> str:
+    res = await get_client().chat.completions.create(
+        model="gpt-5",  # change to gpt-4o if you get model-not-found
+        messages=[system_msg, {"role":"user", "content": content}],
+        # JSON mode: replies parse on the first try instead of falling back to the letter regex.
+        # gpt-5 only accepts the default temperature, and its token cap counts reasoning
+        # tokens, so neither is pinned here.
+        response_format={"type": "json_object"},
+    )
+    try:
+        return res.choices[0].message.content.strip()
+    except Exception:
+        return str(res)
+
+_BATCHER = MicroBatcher(_complete, _SYSTEM_MSG, _BATCH_SYSTEM_MSG, _USER_PART, MAX_BATCH, BATCH_WINDOW)
+
+@app.on_event("startup")
+async def start_batcher():
+    _BATCHER.start()
+
+@app.post("/solve", response_class=ORJSONResponse)
+async def solve(request: Request, files: List[UploadFile] = File(...), qnum: Optional[str] = Form(None)):
+    idem_key = request.headers.get("idempotency-key")
+    if idem_key:
+        replay = _idemp_get(idem_key)
+        if replay is not None:
+            return ORJSONResponse(replay)
+
     # Determine question number: qnum form field -> first filename -> None
     q_number = None
     if qnum:
@@ -175,8 +302,8 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
 
     total_images = len(files) if files else 0
 
-    if client is None:
-        return JSONResponse({
+    if get_client() is None:
+        return ORJSONResponse({
             "question_number": q_number,
             "total_images": total_images,
             "status": "unclear",
@@ -185,36 +312,19 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
             "explanation": "OPENAI_API_KEY not set in env"
         }, status_code=500)
 
-    imgs = []
-    for f in files:
-        data = await f.read()
-        b64 = base64.b64encode(data).decode()
-        imgs.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
-        })
-
-    user_text = (
-        "These images together form a single MCQ (question + options). "
-        "Read all images carefully, perform calculations if needed, and respond with EXACT JSON matching the schema in the system prompt. "
-        "The first uploaded filename may contain the question number; if present, use it. "
-        "Respond only with the required JSON."
-    )
+    encoded = await asyncio.gather(*[_encode(f) for f in files])
+    h = sha256()
+    for digest, _ in encoded:
+        h.update(digest)
+    cache_key = (h.digest(), q_number)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        _idemp_put(idem_key, cached)
+        return ORJSONResponse(cached)
+    imgs = [part for _, part in encoded]
 
     try:
-        res = client.chat.completions.create(
-            model="gpt-5",  # change to gpt-4o if you get model-not-found
-            messages=[
-                {"role":"system", "content": SYSTEM_PROMPT},
-                {"role":"user", "content": [ {"type":"text","text": user_text} ] + imgs}
-            ],
-        )
-
-        raw = ""
-        try:
-            raw = res.choices[0].message.content.strip()
-        except Exception:
-            raw = str(res)
+        raw = await _BATCHER.ask(imgs)
 
         parsed = try_parse_json_candidate(raw)
         if parsed:
@@ -227,7 +337,9 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
             # ensure morse present when correct_option available
             if out["correct_option"] and out["morse"] is None:
                 out["morse"] = MORSE_MAP.get(out["correct_option"])
-            return JSONResponse(out)
+            _cache_put(cache_key, out)
+            _idemp_put(idem_key, out)
+            return ORJSONResponse(out)
 
         # fallback: extract single letter
         letter = fallback_extract_letter(raw)
@@ -240,10 +352,12 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
                 "morse": MORSE_MAP.get(letter),
                 "explanation": None
             }
-            return JSONResponse(out)
+            _cache_put(cache_key, out)
+            _idemp_put(idem_key, out)
+            return ORJSONResponse(out)
 
         # final fallback unclear
-        return JSONResponse({
+        return ORJSONResponse({
             "question_number": q_number,
             "total_images": total_images,
             "status": "unclear",
@@ -255,7 +369,7 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
     except Exception as e:
         letter = fallback_extract_letter(str(e))
         if letter:
-            return JSONResponse({
+            return ORJSONResponse({
                 "question_number": q_number,
                 "total_images": total_images,
                 "status": "ok",
@@ -264,7 +378,7 @@ async def solve(files: List[UploadFile] = File(...), qnum: Optional[str] = Form(
                 "explanation": "extracted from exception"
             }, status_code=200)
 
-        return JSONResponse({
+        return ORJSONResponse({
             "question_number": q_number,
             "total_images": total_images,
             "status": "unclear",
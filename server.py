@@ -1,10 +1,27 @@
 # server.py
 from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from typing import List, Optional
-import openai, base64, os, json
+from collections import OrderedDict
+from PIL import Image
+import os, asyncio
 
-app = FastAPI()
+from mcq_core import content_key, image_data_url, make_async_client, lru_get, lru_put, MicroBatcher, try_parse_json_candidate
+
+# Perceptual-hash cache keys (PHASH_CACHE=1) also hit on re-photographed or re-encoded
+# copies of the same page. Off by default: two pages of one exam template can share a
+# phash, so only enable it where uploads are known to repeat whole questions.
+try:
+    import imagehash
+except ImportError:
+    imagehash = None
+PHASH_CACHE = os.getenv("PHASH_CACHE", "0") == "1" and imagehash is not None
+
+# ---- Response cache: content hash of all images -> parsed model answer (LRU) ----
+CACHE_SIZE = 1024
+CACHE = OrderedDict()
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # ---- OpenAI Project-based Auth ----
 api_key = os.getenv("OPENAI_API_KEY")
@@ -13,7 +30,8 @@ project_id = os.getenv("OPENAI_PROJECT_ID")
 if not api_key:
     raise RuntimeError("Missing OPENAI_API_KEY")
 
-client = openai.OpenAI(api_key=api_key, project=project_id) if project_id else openai.OpenAI(api_key=api_key)
+# one pooled HTTP/2 transport shared by every request (see mcq_core.make_async_client)
+client = make_async_client(api_key, project_id)
 
 SYSTEM_PROMPT = """
 You are an OCR + reasoning assistant for multi-image MCQ questions.
@@ -30,6 +48,22 @@ If image is blurry → status="unclear".
 If more than one answer possible → status="confused".
 """
 
+# Appended to the system prompt when several queued /solve calls share one request
+BATCH_PROMPT = """
+BATCH MODE: this request contains several independent MCQs. Each starts with a "=== Q<n> ===" header followed by its images.
+Answer each one separately using the JSON above and return ONLY JSON of the form:
+{"answers": [<object for Q1>, <object for Q2>, ...]}
+with exactly one object per question, in header order.
+"""
+
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_BATCH_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT + BATCH_PROMPT}
+_USER_TEXT = {"type": "text", "text": "These images together form one MCQ (question + options). Read all carefully and answer with the correct option (A/B/C/D/E)."}
+
+# ---- Micro-batching: concurrent /solve calls within BATCH_WINDOW_MS share one model call ----
+MAX_BATCH = int(os.getenv("MAX_BATCH", "4"))   # 1 disables batching
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW_MS", "50")) / 1000
+
 @app.get("/")
 def home():
     return {"message": "✅ GPT Multi-Image Solver API (Production) Active"}
@@ -50,45 +84,105 @@ def upload_form():
     """
     return HTMLResponse(content=html)
 
+# Phone photos are 3-5 MB; the model tiles at ~1024px anyway, so shrink before base64
+MAX_SIDE = 1024
+JPEG_QUALITY = 80
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "low")  # low | high | auto
+
+def _image_part(fh):
+    # Pillow decode/resize/encode and pybase64 are CPU-bound and release the GIL,
+    # so running this per image in a thread lets a multi-image upload use every core.
+    url = image_data_url(fh, max_side=MAX_SIDE, quality=JPEG_QUALITY, optimize=True)
+    return {
+        "type": "image_url",
+        "image_url": {"url": url, "detail": IMAGE_DETAIL}
+    }
+
+def _phash_key(fhs):
+    # 64-bit DCT hash of each page, in upload order
+    out = ["phash"]
+    for fh in fhs:
+        fh.seek(0)
+        out.append(str(imagehash.phash(Image.open(fh))))
+    return tuple(out)
+
+def _cache_key(fhs):
+    if PHASH_CACHE:
+        try:
+            return _phash_key(fhs)
+        except Exception:
+            pass  # something Pillow can't decode: exact bytes still work
+    return content_key(fhs)
+
+def _cache_put(key, parsed: dict):
+    if not isinstance(parsed, dict) or parsed.get("status") != "ok":
+        return
+    lru_put(CACHE, key, parsed, CACHE_SIZE)
+
+async def _complete(system_msg: dict, content: list, questions: int = 1) -> str:
+    res = await client.chat.completions.create(
+        model="gpt-4o",
+        messages=[system_msg, {"role": "user", "content": content}],
+        # the reply is a few dozen tokens of JSON; deterministic output also keeps the cache honest
+        max_tokens=200 * questions,
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    return res.choices[0].message.content.strip()
+
+_BATCHER = MicroBatcher(_complete, _SYSTEM_MSG, _BATCH_SYSTEM_MSG, _USER_TEXT, MAX_BATCH, BATCH_WINDOW)
+
+@app.on_event("startup")
+async def start_batcher():
+    _BATCHER.start()
+
 @app.post("/solve")
 async def solve(files: List[UploadFile] = File(...), question_number: Optional[str] = Form(None)):
     if not files:
-        return JSONResponse({"status": "unclear", "correct_option": None, "explanation": "No images received."})
+        return ORJSONResponse({"status": "unclear", "correct_option": None, "explanation": "No images received."})
+
+    # work from the spooled upload files directly: memory stays O(chunk) per raw image
+    fhs = [f.file for f in files]
+
+    # identical uploads (retries, test harnesses) skip shrink, encode and the model call
+    key = await asyncio.to_thread(_cache_key, fhs)
+    cached = lru_get(CACHE, key)
+    if cached is not None:
+        parsed = dict(cached)
+        if question_number:
+            parsed["question_number"] = question_number
+        return ORJSONResponse(parsed)
 
-    imgs = []
-    for f in files:
-        data = await f.read()
-        # use base64 data URI so OpenAI can accept inline images
-        imgs.append({
-            "type": "image_url",
-            "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(data).decode()}"}
-        })
+    imgs = await asyncio.gather(*[asyncio.to_thread(_image_part, fh) for fh in fhs])
 
     try:
-        res = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": [
-                    {"type": "text", "text": "These images together form one MCQ (question + options). Read all carefully and answer with the correct option (A/B/C/D/E)."}
-                ] + imgs}
-            ],
-            max_tokens=512,
-        )
-
-        raw = res.choices[0].message.content.strip()
-        try:
-            parsed = json.loads(raw)
-        except Exception:
+        raw = await _BATCHER.ask(imgs)
+        parsed = try_parse_json_candidate(raw)  # dict or None; arrays and scalars are None
+        if parsed is None:
             # fallback if model responded in prose: mark confused and return text
             parsed = {"status": "confused", "correct_option": None, "explanation": raw}
 
+        _cache_put(key, dict(parsed))
+
         # include question_number in response if provided by client
         if question_number:
             parsed["question_number"] = question_number
 
         # Return normalized keys
-        return JSONResponse(parsed)
+        return ORJSONResponse(parsed)
 
     except Exception as e:
-        return JSONResponse({"status": "unclear", "correct_option": None, "explanation": f"Error: {str(e)}"})
+        return ORJSONResponse({"status": "unclear", "correct_option": None, "explanation": f"Error: {str(e)}"})
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools when installed (uvicorn[standard]); one worker per core so
+    # Pillow/base64 preprocessing in one process doesn't queue the others
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
@@ -1,6 +1,6 @@
 # server_queue.py
 """
-FastAPI server implementing in-memory queue + worker threads + child-process GPT call.
+FastAPI server implementing in-memory queue + async worker tasks; the GPT call is awaited on the event loop.
 
 Run with:
   uvicorn server_queue:app --host 0.0.0.0 --port $PORT --workers 1
@@ -8,29 +8,29 @@ Run with:
 Env vars (optional):
   OPENAI_API_KEY      - your OpenAI key (recommended)
   OPENAI_PROJECT_ID   - your OpenAI project id (for sk-proj-... keys) (optional but recommended if using sk-proj keys)
-  WORKER_COUNT        - number of worker threads (default 3)
-  CHILD_TIMEOUT       - seconds to wait for child before killing it (default 150)
+  WORKER_COUNT        - number of workers (default 3)
+  CHILD_TIMEOUT       - per-task timeout in seconds, retries included (default 150)
   UPLOAD_ROOT         - base folder for uploads (default /tmp/uploads)
+  MAX_QUEUE           - queued tasks allowed before /upload answers 503 (default 4 x WORKER_COUNT)
 """
 
 import os
+import re
 import uuid
-import time
-import json
-import shutil
+import asyncio
+import orjson
 import traceback
 from pathlib import Path
-from multiprocessing import Process
-from threading import Thread
-import queue
 from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, HTMLResponse, StreamingResponse
+
+from mcq_core import TaskStore, make_async_client
 
 # Try importing the modern OpenAI SDK client (preferred)
 try:
-    from openai import OpenAI as OpenAIClient
+    from openai import AsyncOpenAI as OpenAIClient
     OPENAI_SDK_AVAILABLE = True
 except Exception:
     OpenAIClient = None
@@ -46,71 +46,42 @@ except Exception:
 
 # ---------- Configuration with sensible defaults ----------
 UPLOAD_ROOT = Path(os.environ.get("UPLOAD_ROOT", "/tmp/uploads"))
-UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 
 WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "3"))
 CHILD_TIMEOUT = int(os.environ.get("CHILD_TIMEOUT", "150"))
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(WORKER_COUNT * 4)))
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")  # required for real GPT calls
 OPENAI_PROJECT_ID = os.environ.get("OPENAI_PROJECT_ID")  # optional but required for sk-proj keys
 
 # ---------- In-memory state ----------
-TASK_QUEUE = queue.Queue()
-TASKS = {}      # task_id -> status: queued | processing | done | failed | cancelled
-RESULTS = {}    # task_id -> result dict
-CANCELLED = set()
-# Map task_id -> child process object so cancel endpoint can terminate running child
-PROCESS_MAP = {}
-
-app = FastAPI(title="Exam Solver Queue Server (with OpenAI project support)")
-
-
-# ---------- Utility helpers ----------
-def save_upload_files(task_id: str, files: List[UploadFile]):
-    dest = UPLOAD_ROOT / task_id
-    dest.mkdir(parents=True, exist_ok=True)
-    paths = []
-    for i, f in enumerate(files):
-        ext = Path(f.filename).suffix or ".jpg"
-        target = dest / f"img_{i}{ext}"
-        with target.open("wb") as fh:
-            fh.write(f.file.read())
-        paths.append(str(target))
-    return paths
-
-
-def write_result_file(task_id: str, payload: dict):
-    p = UPLOAD_ROOT / task_id / "result.json"
-    try:
-        p.write_text(json.dumps(payload))
-    except Exception:
-        pass
+STORE = TaskStore(UPLOAD_ROOT, MAX_QUEUE)  # task records, bounded queue, upload dirs
+WORKER_TASKS = set()  # keep references to the worker coroutines
 
+app = FastAPI(title="Exam Solver Queue Server (with OpenAI project support)", default_response_class=ORJSONResponse)
 
-def read_result_file(task_id: str):
-    p = UPLOAD_ROOT / task_id / "result.json"
-    if p.exists():
-        try:
-            return json.loads(p.read_text())
-        except Exception:
-            return None
-    return None
+
+# ---------- Task work ----------
+_ANSWER_RE = re.compile(r"[A-D]", re.IGNORECASE)
+_client = None  # shared across tasks
+
+_SYSTEM_MSG = {"role": "system", "content": "You are an expert exam-solver that examines images and returns the correct multiple-choice option."}
+_PROMPT_TAIL = " Return JSON only: {\"correct_option\":\"A|B|C|D\",\"explanation\":\"...\"}."
 
 
-# ---------- Child process work ----------
-def child_process_work(task_id: str, image_paths: List[str], question_number: Optional[str]):
+async def do_work(task_id: str, image_paths: List[str], question_number: Optional[str]):
     """
-    Runs in a separate process. Writes a JSON file /tmp/uploads/<task_id>/result.json
-    with either:
+    Awaited by a worker coroutine (the work is one HTTP call; no thread or process needed). Returns either:
       { "status": "done", "result": {...} }
     or
       { "status": "failed", "error": "..." }
     """
+    global _client
     try:
         # Basic system/user prompt — adapt to your final prompt
         prompt = f"You are an expert exam-solver. There are {len(image_paths)} images for one question."
         if question_number:
             prompt += f" Question number: {question_number}."
-        prompt += " Return JSON only: {\"correct_option\":\"A|B|C|D\",\"explanation\":\"...\"}."
+        prompt += _PROMPT_TAIL
 
         # If no OpenAI key or SDK available -> simulated response for quick testing
         if (not OPENAI_API_KEY) or (not OPENAI_SDK_AVAILABLE and not LEGACY_OPENAI_AVAILABLE):
@@ -118,25 +89,23 @@ def child_process_work(task_id: str, image_paths: List[str], question_number: Op
                 "correct_option": "A",
                 "explanation": "Simulated result (OPENAI_API_KEY or OpenAI SDK not configured)."
             }
-            write_result_file(task_id, {"status": "done", "result": simulated})
-            return
+            return {"status": "done", "result": simulated}
 
         # === Preferred: modern OpenAI SDK (from openai import OpenAI) ===
         if OPENAI_SDK_AVAILABLE:
-            # Create client. If OPENAI_PROJECT_ID is provided, pass it; else create without project arg.
-            if OPENAI_PROJECT_ID:
-                client = OpenAIClient(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT_ID)
-            else:
-                client = OpenAIClient(api_key=OPENAI_API_KEY)
+            # Create client once. If OPENAI_PROJECT_ID is provided, pass it; else create without project arg.
+            # SDK retries (429/5xx/connection errors) stay on; the worker's wait_for bounds the total time.
+            if _client is None:
+                _client = make_async_client(OPENAI_API_KEY, OPENAI_PROJECT_ID)
+            client = _client
 
-            system_msg = {"role": "system", "content": "You are an expert exam-solver that examines images and returns the correct multiple-choice option."}
             user_msg = {"role": "user", "content": prompt + " Do not include any commentary; respond with a JSON object."}
 
             # Use Chat Completions create for modern client
             try:
-                resp = client.chat.completions.create(
+                resp = await client.chat.completions.create(
                     model="gpt-4o-mini",  # change to a model you have access to
-                    messages=[system_msg, user_msg],
+                    messages=[_SYSTEM_MSG, user_msg],
                     max_tokens=200,
                     temperature=0
                 )
@@ -153,111 +122,104 @@ def child_process_work(task_id: str, image_paths: List[str], question_number: Op
 
             except Exception as e:
                 # If SDK call fails, write failure
-                write_result_file(task_id, {"status": "failed", "error": f"OpenAI SDK call error: {e}", "trace": traceback.format_exc()})
-                return
+                return {"status": "failed", "error": f"OpenAI SDK call error: {e}", "trace": traceback.format_exc()}
 
-        # === Fallback: legacy openai package (openai.ChatCompletion.create) ===
+        # === Fallback: legacy openai package (openai.ChatCompletion.acreate) ===
         elif LEGACY_OPENAI_AVAILABLE:
             try:
                 legacy_openai.api_key = OPENAI_API_KEY
                 # Some legacy setups require organization/project info in headers; not handled here.
-                resp = legacy_openai.ChatCompletion.create(
+                resp = await legacy_openai.ChatCompletion.acreate(
                     model="gpt-4o-mini",
                     messages=[
-                        {"role": "system", "content": "You are an expert exam-solver that examines images and returns the correct multiple-choice option."},
+                        _SYSTEM_MSG,
                         {"role": "user", "content": prompt + " Do not include commentary; reply with JSON."}
                     ],
                     max_tokens=200,
-                    temperature=0
+                    temperature=0,
+                    request_timeout=CHILD_TIMEOUT
                 )
                 text = resp["choices"][0]["message"]["content"].strip()
             except Exception as e:
-                write_result_file(task_id, {"status": "failed", "error": f"legacy openai call error: {e}", "trace": traceback.format_exc()})
-                return
+                return {"status": "failed", "error": f"legacy openai call error: {e}", "trace": traceback.format_exc()}
         else:
             # shouldn't reach here; safety fallback
-            write_result_file(task_id, {"status": "failed", "error": "No OpenAI SDK available."})
-            return
+            return {"status": "failed", "error": "No OpenAI SDK available."}
 
         # Attempt to parse JSON; if fails, extract first letter A-D
         try:
-            parsed = json.loads(text)
+            parsed = orjson.loads(text)
             if "correct_option" in parsed:
                 result = parsed
             else:
-                import re
-                m = re.search(r"[A-D]", text.upper())
-                result = {"correct_option": m.group(0) if m else None, "raw": parsed}
+                m = _ANSWER_RE.search(text)
+                result = {"correct_option": m.group(0).upper() if m else None, "raw": parsed}
         except Exception:
-            import re
-            m = re.search(r"[A-D]", text.upper()) if isinstance(text, str) else None
-            result = {"correct_option": m.group(0) if m else None, "raw": text}
+            m = _ANSWER_RE.search(text) if isinstance(text, str) else None
+            result = {"correct_option": m.group(0).upper() if m else None, "raw": text}
 
-        write_result_file(task_id, {"status": "done", "result": result})
+        return {"status": "done", "result": result}
 
     except Exception as e:
-        write_result_file(task_id, {"status": "failed", "error": str(e), "trace": traceback.format_exc()})
+        return {"status": "failed", "error": str(e), "trace": traceback.format_exc()}
 
 
 # ---------- Worker loop ----------
-def worker_loop(worker_idx: int):
+def save_result(task_id: str, payload: dict):
+    # result.json is written on the default executor; the worker moves straight on
+    asyncio.get_running_loop().run_in_executor(None, STORE.write_result, task_id, payload)
+
+
+async def worker_loop(worker_idx: int):
     print(f"[worker-{worker_idx}] started")
     while True:
-        task = TASK_QUEUE.get()
+        task = await STORE.queue.get()
         task_id = task["task_id"]
+        rec = STORE.tasks[task_id]
 
-        if task_id in CANCELLED:
-            TASKS[task_id] = "cancelled"
-            TASK_QUEUE.task_done()
-            print(f"[worker-{worker_idx}] task {task_id} cancelled before start")
-            continue
+        with STORE.lock:
+            if rec.cancelled:
+                rec.done_event.set()
+                STORE.queue.task_done()
+                print(f"[worker-{worker_idx}] task {task_id} cancelled before start")
+                continue
+            rec.status = "processing"
+            rec.future = fut = asyncio.ensure_future(do_work(task_id, task["image_paths"], task.get("question_number")))
 
         try:
-            TASKS[task_id] = "processing"
-            image_paths = task["image_paths"]
-            question_number = task.get("question_number")
-
-            p = Process(target=child_process_work, args=(task_id, image_paths, question_number))
-            PROCESS_MAP[task_id] = p
-            p.start()
-            p.join(CHILD_TIMEOUT)
-
-            if p.is_alive():
-                print(f"[worker-{worker_idx}] task {task_id} timeout; terminating child")
-                p.terminate()
-                p.join()
-                TASKS[task_id] = "failed"
-                RESULTS[task_id] = {"error": "timeout"}
-                write_result_file(task_id, {"status": "failed", "error": "timeout"})
-            else:
-                res = read_result_file(task_id)
-                if res is None:
-                    TASKS[task_id] = "failed"
-                    RESULTS[task_id] = {"error": "no_result_file"}
-                else:
-                    if res.get("status") == "done":
-                        TASKS[task_id] = "done"
-                        RESULTS[task_id] = res.get("result")
-                    else:
-                        TASKS[task_id] = "failed"
-                        RESULTS[task_id] = res
+            try:
+                res = await asyncio.wait_for(fut, CHILD_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[worker-{worker_idx}] task {task_id} timeout")
+                if STORE.finish(rec, "failed", {"error": "timeout"}):
+                    save_result(task_id, {"status": "failed", "error": "timeout"})
+                continue
+            except asyncio.CancelledError:
+                if not rec.cancelled:
+                    raise  # server shutting down
+                # cancelled by /cancel: the HTTP request is aborted with the coroutine
+                continue
+
+            if res.get("status") == "done":
+                if STORE.finish(rec, "done", res.get("result")):
+                    save_result(task_id, res)
+            elif STORE.finish(rec, "failed", res):
+                save_result(task_id, res)
         except Exception as e:
-            TASKS[task_id] = "failed"
-            RESULTS[task_id] = {"error": str(e)}
+            if STORE.finish(rec, "failed", {"error": str(e)}):
+                save_result(task_id, {"status": "failed", "error": str(e)})
             print(f"[worker-{worker_idx}] exception: {e}")
         finally:
-            PROCESS_MAP.pop(task_id, None)
-            TASK_QUEUE.task_done()
+            STORE.queue.task_done()
 
 
 # ---------- FastAPI endpoints ----------
 @app.on_event("startup")
-def startup_event():
-    # spawn worker threads
+async def startup_event():
+    # WORKER_COUNT coroutines bound how many GPT calls are in flight; no threads involved
     for i in range(WORKER_COUNT):
-        t = Thread(target=worker_loop, args=(i,), daemon=True)
-        t.start()
-    print(f"Server started with {WORKER_COUNT} worker threads (CHILD_TIMEOUT={CHILD_TIMEOUT}s)")
+        WORKER_TASKS.add(asyncio.create_task(worker_loop(i)))
+    print(f"Server started with {WORKER_COUNT} workers (CHILD_TIMEOUT={CHILD_TIMEOUT}s)")
     print(f"OpenAI SDK available: {OPENAI_SDK_AVAILABLE}, legacy openai available: {LEGACY_OPENAI_AVAILABLE}")
 
 
@@ -266,43 +228,58 @@ async def upload_endpoint(files: List[UploadFile] = File(...), batch_id: Optiona
                           question_number: Optional[str] = Form(None)):
     task_id = str(uuid.uuid4())
     try:
-        paths = save_upload_files(task_id, files)
+        queued = await STORE.submit(task_id, files, batch_id=batch_id, question_number=question_number)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed saving files: {e}")
+    if not queued:
+        raise HTTPException(status_code=503, detail="Server busy, retry later")
 
-    TASKS[task_id] = "queued"
-    TASK_QUEUE.put({"task_id": task_id, "image_paths": paths, "batch_id": batch_id, "question_number": question_number})
-
-    return JSONResponse({"task_id": task_id, "status": "queued"})
+    return ORJSONResponse({"task_id": task_id, "status": "queued"})
 
 
 @app.get("/result/{task_id}")
 def result_endpoint(task_id: str):
-    status = TASKS.get(task_id)
-    res = RESULTS.get(task_id)
-    if status is None:
-        return JSONResponse({"error": "unknown task_id"}, status_code=404)
-    return JSONResponse({"task_id": task_id, "status": status, "result": res})
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error": "unknown task_id"}, status_code=404)
+    with STORE.lock:
+        status, res = rec.status, rec.result
+    return ORJSONResponse({"task_id": task_id, "status": status, "result": res})
+
+
+@app.get("/result/{task_id}/stream")
+async def result_stream_endpoint(task_id: str):
+    """
+    Server-Sent Events alternative to polling /result: one event is pushed
+    when the task reaches done / failed / cancelled.
+    """
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error": "unknown task_id"}, status_code=404)
+    return StreamingResponse(STORE.result_events(task_id, rec), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @app.post("/cancel/{task_id}")
-def cancel_endpoint(task_id: str):
-    if task_id not in TASKS:
-        return JSONResponse({"error": "unknown task_id"}, status_code=404)
-
-    # If queued, mark cancelled; if processing, try to terminate child
-    CANCELLED.add(task_id)
-    TASKS[task_id] = "cancelled"
-    p = PROCESS_MAP.get(task_id)
-    if p is not None and p.is_alive():
-        try:
-            p.terminate()
-            p.join(timeout=5)
-            write_result_file(task_id, {"status": "failed", "error": "cancelled_by_user"})
-            RESULTS[task_id] = {"error": "cancelled_by_user"}
-        except Exception:
-            pass
-    return JSONResponse({"task_id": task_id, "status": "cancelled"})
+async def cancel_endpoint(task_id: str, background_tasks: BackgroundTasks):
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error": "unknown task_id"}, status_code=404)
+
+    # If queued, mark cancelled; if processing, stop waiting on it so the worker moves on
+    with STORE.lock:
+        rec.cancelled = True
+        rec.status = "cancelled"
+        fut, rec.future = rec.future, None
+        if fut is not None and not fut.done():
+            fut.cancel()
+            rec.result = {"error": "cancelled_by_user"}
+        else:
+            fut = None
+    rec.done_event.set()
+    if fut is not None:
+        # the result file is written after the response; the in-memory state is already final
+        background_tasks.add_task(STORE.write_result, task_id, {"status": "failed", "error": "cancelled_by_user"})
+    return ORJSONResponse({"task_id": task_id, "status": "cancelled"})
 
 
 @app.get("/test")
@@ -325,18 +302,11 @@ def test_html():
     return HTMLResponse(content=html)
 
 
-@app.post("/cleanup_older")
-def cleanup_older(days: int = 1):
-    cutoff = time.time() - days * 86400
-    removed = []
-    for d in UPLOAD_ROOT.iterdir():
-        try:
-            if d.is_dir() and d.stat().st_mtime < cutoff:
-                shutil.rmtree(d)
-                removed.append(d.name)
-        except Exception:
-            pass
-    return {"removed": removed}
+@app.post("/cleanup_older", status_code=202)
+def cleanup_older(background_tasks: BackgroundTasks, days: int = 1):
+    # one rmtree per day bucket, run after the response is sent
+    background_tasks.add_task(STORE.remove_old_buckets, days)
+    return {"status": "scheduled"}
 
 
 # For local run convenience
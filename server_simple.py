@@ -1,6 +1,6 @@
 # server_simple.py
 """
-Minimal queue server with 2 worker threads and small task IDs.
+Minimal queue server with 2 async workers and small task IDs.
 Run:
   uvicorn server_simple:app --host 0.0.0.0 --port $PORT --workers 1
 
@@ -9,20 +9,24 @@ Env vars:
   OPENAI_PROJECT_ID   - optional (use if your key is sk-proj-...)
   WORKER_COUNT        - optional (default 2)
   UPLOAD_ROOT         - optional (default /tmp/uploads)
+  MAX_QUEUE           - optional, queued tasks before /upload answers 503 (default 4 x WORKER_COUNT)
+  MAX_BATCH           - optional, queued questions answered by one GPT call (default 4; 1 disables)
+  BATCH_WINDOW_MS     - optional, how long a worker waits to fill a batch (default 50)
 """
 
-import os, uuid, time, json, shutil, traceback
+import os, re, uuid, mmap, traceback, asyncio
+import orjson
 from pathlib import Path
-from threading import Thread, Lock
-import queue
 from typing import List, Optional
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, HTMLResponse, StreamingResponse
+
+from mcq_core import TaskRecord, TaskStore, b64encode_as_string, image_mime, make_async_client, shrink_image
 
 # OpenAI client support: prefer modern client, fallback to legacy
 try:
-    from openai import OpenAI as OpenAIClient
+    from openai import AsyncOpenAI as OpenAIClient
     MODERN_OPENAI = True
 except Exception:
     OpenAIClient = None
@@ -37,120 +41,106 @@ except Exception:
 
 # Configs and envs
 UPLOAD_ROOT = Path(os.environ.get("UPLOAD_ROOT", "/tmp/uploads"))
-UPLOAD_ROOT.mkdir(parents=True, exist_ok=True)
 
 WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "2"))
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(WORKER_COUNT * 4)))
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "4"))   # 1 disables batching
+BATCH_WINDOW = int(os.environ.get("BATCH_WINDOW_MS", "50")) / 1000
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 OPENAI_PROJECT_ID = os.environ.get("OPENAI_PROJECT_ID")
 
 # In-memory state
-TASK_QUEUE = queue.Queue()
-TASKS = {}    # task_id -> status
-RESULTS = {}  # task_id -> result
-CANCELLED = set()
-PROCESSING = set()
+STORE = TaskStore(UPLOAD_ROOT, MAX_QUEUE)  # task records, bounded queue, upload dirs
+WORKER_TASKS = set()  # keep references to the worker coroutines
+MODEL_SLOTS = asyncio.Semaphore(WORKER_COUNT)  # model calls in flight, batch fallbacks included
+
+OPENAI_CLIENT = None  # set in startup()
 
-app = FastAPI(title="Simple 2-worker Exam Solver")
+app = FastAPI(title="Simple 2-worker Exam Solver", default_response_class=ORJSONResponse)
 
-# small task id generator
+# small task id generator (only called from the event loop, so no lock)
 _counter = 0
-_counter_lock = Lock()
 def next_task_id():
     global _counter
-    with _counter_lock:
-        _counter += 1
-        return f"t{_counter:04d}"   # t0001, t0002, ...
-
-# helpers for file save/read
-def save_upload_files(task_id: str, files: List[UploadFile]):
-    dest = UPLOAD_ROOT / task_id
-    dest.mkdir(parents=True, exist_ok=True)
-    paths = []
-    for i, f in enumerate(files):
-        ext = Path(f.filename).suffix or ".jpg"
-        target = dest / f"img_{i}{ext}"
-        with target.open("wb") as fh:
-            fh.write(f.file.read())
-        paths.append(str(target))
-    return paths
-
-def write_result_file(task_id: str, payload: dict):
-    p = UPLOAD_ROOT / task_id / "result.json"
-    try:
-        p.write_text(json.dumps(payload))
-    except Exception:
-        pass
+    _counter += 1
+    return f"t{_counter:04d}"   # t0001, t0002, ...
 
-def read_result_file(task_id: str):
-    p = UPLOAD_ROOT / task_id / "result.json"
-    if p.exists():
-        try:
-            return json.loads(p.read_text())
-        except Exception:
-            return None
-    return None
-
-# build an openai client instance (call inside worker to avoid sharing issues)
+# build an openai client instance; created once at startup and shared by the workers
+# (sharing it lets keep-alive reuse sockets across tasks)
 def make_openai_client():
     if not OPENAI_API_KEY:
         return None
     if MODERN_OPENAI:
-        if OPENAI_PROJECT_ID:
-            return OpenAIClient(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT_ID)
-        return OpenAIClient(api_key=OPENAI_API_KEY)
+        return make_async_client(OPENAI_API_KEY, OPENAI_PROJECT_ID)
     if LEGACY_OPENAI:
         legacy_openai.api_key = OPENAI_API_KEY
         return legacy_openai
     return None
 
-# worker function (no multiprocessing; OpenAI call happens in the thread)
-def worker_loop(worker_idx: int):
-    print(f"[worker-{worker_idx}] started")
-    while True:
-        task = TASK_QUEUE.get()
-        task_id = task["task_id"]
-        image_paths = task["image_paths"]
-        qnum = task.get("question_number")
-        if task_id in CANCELLED:
-            TASKS[task_id] = "cancelled"
-            TASK_QUEUE.task_done()
-            continue
+def image_data_url(path: str) -> str:
+    # mmap the saved upload: Pillow and the base64 encoder read the mapped pages in place,
+    # so an image that needs no resize is never copied into a bytes object
+    with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = shrink_image(mm)
+        mime = "image/jpeg" if isinstance(data, bytes) else image_mime(mm[:12])  # as uploaded: real type
+        return f"data:{mime};base64," + b64encode_as_string(data)
 
+SYSTEM_PROMPT = "You are an expert exam solver. Given the images, return JSON: {\"status\":\"ok\",\"correct_option\":\"A|B|C|D|E\",\"explanation\":\"...\"}"
+_SYSTEM_MSG = {"role":"system","content":SYSTEM_PROMPT}
+_USER_TEXT = "These images together form one MCQ. Answer with JSON."
+_USER_TEXT_PART = {"type":"text","text":_USER_TEXT}
+_LEGACY_USER_MSG = {"role":"user","content":_USER_TEXT}
+
+# Several queued questions that arrive within BATCH_WINDOW_MS share one model call
+BATCH_PROMPT = (" BATCH MODE: the images belong to several independent MCQs, each introduced by a \"=== Q<n> ===\" header."
+                " Return ONLY JSON of the form {\"answers\": [<object for Q1>, <object for Q2>, ...]}"
+                " with exactly one object per question, in header order.")
+_BATCH_SYSTEM_MSG = {"role":"system","content":SYSTEM_PROMPT + BATCH_PROMPT}
+_BATCH_USER_TEXT_PART = {"type":"text","text":"Answer every question below with JSON."}
+
+_ANSWER_RE = re.compile(r"[A-E]", re.IGNORECASE)
+
+async def load_images(image_paths: List[str]) -> list:
+    # Read images as base64 dataurls, downscaled first so the upload to OpenAI stays small;
+    # Pillow/base64 are CPU work, so they run off the event loop.
+    # One unreadable (or empty) image fails the task: the model would only guess without it
+    imgs = []
+    for p in image_paths:
         try:
-            TASKS[task_id] = "processing"
-            PROCESSING.add(task_id)
-            # Build prompt/messages (simple)
-            system_prompt = "You are an expert exam solver. Given the images, return JSON: {\"status\":\"ok\",\"correct_option\":\"A|B|C|D|E\",\"explanation\":\"...\"}"
-
-            # Read images as base64 dataurls (small sample; advisable to compress on Pi)
-            imgs = []
-            for p in image_paths:
-                try:
-                    b = Path(p).read_bytes()
-                    import base64
-                    imgs.append({"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{base64.b64encode(b).decode()}"}})
-                except Exception:
-                    pass
-
-            client = make_openai_client()
-            if not client:
-                # simulated result (for testing without API)
-                res = {"status":"ok","correct_option":"A","explanation":"simulated (no OPENAI_API_KEY)"}
-                RESULTS[task_id] = res
-                TASKS[task_id] = "done"
-                write_result_file(task_id, {"status":"done","result":res})
-                PROCESSING.discard(task_id)
-                TASK_QUEUE.task_done()
-                continue
-
-            # Perform ChatCompletion call (modern or legacy)
-            text = None
-            try:
+            imgs.append({"type":"image_url","image_url":{"url": await asyncio.to_thread(image_data_url, p)}})
+        except Exception as e:
+            raise ValueError(f"Failed to read image {Path(p).name}: {e}") from e
+    return imgs
+
+def parse_answer(text):
+    try:
+        return orjson.loads(text)
+    except Exception:
+        m = _ANSWER_RE.search(text) if isinstance(text, str) else None
+        return {"status":"confused","correct_option": m.group(0).upper() if m else None, "explanation": text}
+
+async def fail_task(task_id: str, rec: TaskRecord, e: Exception):
+    if STORE.finish(rec, "failed", {"error": str(e)}):
+        await asyncio.to_thread(STORE.write_result, task_id, {"status":"failed","error":str(e),"trace":"".join(traceback.format_exception(e))})
+
+async def solve_task(task_id: str, rec: TaskRecord, imgs: list):
+    try:
+        client = OPENAI_CLIENT
+        if not client:
+            # simulated result (for testing without API)
+            res = {"status":"ok","correct_option":"A","explanation":"simulated (no OPENAI_API_KEY)"}
+            if STORE.finish(rec, "done", res):
+                await asyncio.to_thread(STORE.write_result, task_id, {"status":"done","result":res})
+            return
+
+        # Perform ChatCompletion call (modern or legacy)
+        text = None
+        try:
+            async with MODEL_SLOTS:
                 if MODERN_OPENAI:
-                    resp = client.chat.completions.create(
+                    resp = await client.chat.completions.create(
                         model="gpt-4o-mini",   # change to model you have access to
-                        messages=[{"role":"system","content":system_prompt},
-                                  {"role":"user","content":[{"type":"text","text":"These images together form one MCQ. Answer with JSON."}] + imgs}],
+                        messages=[_SYSTEM_MSG, {"role":"user","content":[_USER_TEXT_PART, *imgs]}],
                         max_tokens=200, temperature=0
                     )
                     try:
@@ -158,53 +148,108 @@ def worker_loop(worker_idx: int):
                     except Exception:
                         text = str(resp)
                 else:
-                    resp = client.ChatCompletion.create(
+                    resp = await client.ChatCompletion.acreate(
                         model="gpt-4o-mini",
-                        messages=[{"role":"system","content":system_prompt},
-                                  {"role":"user","content":"These images together form one MCQ. Answer with JSON."}],
+                        messages=[_SYSTEM_MSG, _LEGACY_USER_MSG],
                         max_tokens=200, temperature=0
                     )
                     text = resp["choices"][0]["message"]["content"].strip()
-            except Exception as e:
-                # log & mark failed
-                TASKS[task_id] = "failed"
-                RESULTS[task_id] = {"error": str(e)}
-                write_result_file(task_id, {"status":"failed","error":str(e),"trace":traceback.format_exc()})
-                PROCESSING.discard(task_id)
-                TASK_QUEUE.task_done()
-                continue
-
-            # parse output
-            try:
-                parsed = json.loads(text)
-            except Exception:
-                import re
-                m = re.search(r"[A-E]", text.upper()) if isinstance(text, str) else None
-                parsed = {"status":"confused","correct_option": m.group(0) if m else None, "explanation": text}
-
-            RESULTS[task_id] = parsed
-            TASKS[task_id] = "done"
-            write_result_file(task_id, {"status":"done","result":parsed})
         except Exception as e:
-            TASKS[task_id] = "failed"
-            RESULTS[task_id] = {"error": str(e)}
-            write_result_file(task_id, {"status":"failed","error":str(e),"trace":traceback.format_exc()})
-        finally:
-            PROCESSING.discard(task_id)
-            TASK_QUEUE.task_done()
+            # log & mark failed
+            await fail_task(task_id, rec, e)
+            return
+
+        parsed = parse_answer(text)
+        if STORE.finish(rec, "done", parsed):
+            await asyncio.to_thread(STORE.write_result, task_id, {"status":"done","result":parsed})
+    except Exception as e:
+        await fail_task(task_id, rec, e)
+
+async def solve_batch(batch: list):
+    # batch: [(task_id, rec, imgs), ...] answered by one multimodal call
+    content = [_BATCH_USER_TEXT_PART]
+    for i, (_, _, imgs) in enumerate(batch, 1):
+        content.append({"type":"text","text":f"=== Q{i} ==="})
+        content.extend(imgs)
+    answers = None
+    try:
+        async with MODEL_SLOTS:
+            resp = await OPENAI_CLIENT.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[_BATCH_SYSTEM_MSG, {"role":"user","content":content}],
+                max_tokens=200 * len(batch), temperature=0,
+                response_format={"type":"json_object"}
+            )
+        parsed = orjson.loads(resp.choices[0].message.content)
+        if isinstance(parsed, dict) and isinstance(parsed.get("answers"), list) and len(parsed["answers"]) == len(batch):
+            answers = parsed["answers"]
+    except Exception:
+        pass
+    if answers is None:
+        # call failed or the reply broke the array contract: answer each question on its own
+        await asyncio.gather(*[solve_task(*item) for item in batch])
+        return
+    for (task_id, rec, _), answer in zip(batch, answers):
+        if STORE.finish(rec, "done", answer):
+            await asyncio.to_thread(STORE.write_result, task_id, {"status":"done","result":answer})
+
+async def next_batch() -> list:
+    # first task blocks; then up to MAX_BATCH-1 more that arrive within BATCH_WINDOW
+    batch = [await STORE.queue.get()]
+    if MAX_BATCH <= 1 or not (MODERN_OPENAI and OPENAI_CLIENT):
+        return batch  # the legacy path sends no images, and the simulator needs no batching
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_WINDOW
+    while len(batch) < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(STORE.queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+# worker coroutine: WORKER_COUNT of these bound how many OpenAI calls are in flight
+async def worker_loop(worker_idx: int):
+    print(f"[worker-{worker_idx}] started")
+    while True:
+        claimed = []
+        for task in await next_batch():
+            task_id = task["task_id"]
+            rec = STORE.tasks[task_id]
+            with STORE.lock:
+                if rec.cancelled:
+                    rec.done_event.set()
+                    continue
+                rec.status = "processing"
+            claimed.append((task_id, rec, task["image_paths"]))
+
+        all_imgs = await asyncio.gather(*[load_images(paths) for _, _, paths in claimed], return_exceptions=True)
+        batch = []
+        for (task_id, rec, _), imgs in zip(claimed, all_imgs):
+            if isinstance(imgs, Exception):
+                await fail_task(task_id, rec, imgs)
+            else:
+                batch.append((task_id, rec, imgs))
+        if len(batch) == 1:
+            await solve_task(*batch[0])
+        elif batch:
+            await solve_batch(batch)
 
 # spawn workers at startup
 @app.on_event("startup")
-def startup():
+async def startup():
+    global OPENAI_CLIENT
+    OPENAI_CLIENT = make_openai_client()
     for i in range(WORKER_COUNT):
-        t = Thread(target=worker_loop, args=(i,), daemon=True)
-        t.start()
+        WORKER_TASKS.add(asyncio.create_task(worker_loop(i)))
     print(f"Simple server started with {WORKER_COUNT} workers")
 
 # ROUTES
 @app.get("/")
 def home():
-    return {"message":"Simple 2-worker server active"}
+    return {"message":"Simple 2-worker server active", "queued": STORE.queue.qsize(), "max_queue": MAX_QUEUE}
 
 @app.get("/test", response_class=HTMLResponse)
 def test_form():
@@ -219,39 +264,46 @@ def test_form():
 
 @app.post("/upload")
 async def upload_endpoint(files: List[UploadFile] = File(...), batch_id: Optional[str] = Form(None), question_number: Optional[str] = Form(None)):
+    # backpressure: a flood of uploads gets 503s instead of filling disk and RAM
     task_id = next_task_id()
     try:
-        paths = save_upload_files(task_id, files)
+        queued = await STORE.submit(task_id, files, batch_id=batch_id, question_number=question_number)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed saving files: {e}")
-    TASKS[task_id] = "queued"
-    TASK_QUEUE.put({"task_id": task_id, "image_paths": paths, "batch_id": batch_id, "question_number": question_number})
-    return JSONResponse({"task_id": task_id, "status":"queued"})
+    if not queued:
+        raise HTTPException(status_code=503, detail="Server busy, retry later")
+    return ORJSONResponse({"task_id": task_id, "status":"queued"})
 
 @app.get("/result/{task_id}")
 def result_endpoint(task_id: str):
-    status = TASKS.get(task_id)
-    res = RESULTS.get(task_id)
-    if status is None:
-        return JSONResponse({"error":"unknown task_id"}, status_code=404)
-    return JSONResponse({"task_id":task_id, "status":status, "result":res})
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error":"unknown task_id"}, status_code=404)
+    with STORE.lock:
+        status, res = rec.status, rec.result
+    return ORJSONResponse({"task_id":task_id, "status":status, "result":res})
+
+@app.get("/result/{task_id}/stream")
+async def result_stream_endpoint(task_id: str):
+    # Server-Sent Events alternative to polling /result: one event when the task is final
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error":"unknown task_id"}, status_code=404)
+    return StreamingResponse(STORE.result_events(task_id, rec), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
 
 @app.post("/cancel/{task_id}")
-def cancel_endpoint(task_id: str):
-    if task_id not in TASKS:
-        return JSONResponse({"error":"unknown task_id"}, status_code=404)
-    CANCELLED.add(task_id)
-    TASKS[task_id] = "cancelled"
-    return JSONResponse({"task_id":task_id, "status":"cancelled"})
-
-@app.post("/cleanup_older")
-def cleanup_older(days: int = 1):
-    cutoff = time.time() - days*86400
-    removed=[]
-    for d in UPLOAD_ROOT.iterdir():
-        try:
-            if d.is_dir() and d.stat().st_mtime < cutoff:
-                shutil.rmtree(d); removed.append(d.name)
-        except Exception:
-            pass
-    return {"removed":removed}
+async def cancel_endpoint(task_id: str):
+    rec = STORE.tasks.get(task_id)
+    if rec is None:
+        return ORJSONResponse({"error":"unknown task_id"}, status_code=404)
+    with STORE.lock:
+        rec.cancelled = True
+        rec.status = "cancelled"
+    rec.done_event.set()
+    return ORJSONResponse({"task_id":task_id, "status":"cancelled"})
+
+@app.post("/cleanup_older", status_code=202)
+def cleanup_older(background_tasks: BackgroundTasks, days: int = 1):
+    # one rmtree per day bucket, run after the response is sent
+    background_tasks.add_task(STORE.remove_old_buckets, days)
+    return {"status":"scheduled"}
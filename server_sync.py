@@ -1,6 +1,6 @@
 # server_sync.py
 """
-Minimal synchronous FastAPI server for multi-image MCQ solving (no queue / no workers).
+Minimal direct FastAPI server for multi-image MCQ solving (no queue / no workers).
 - POST /solve  : upload images, call OpenAI immediately, return JSON answer.
 - GET  /test   : small HTML upload form for manual testing.
 
@@ -10,23 +10,28 @@ Run:
 Env vars:
   OPENAI_API_KEY      - required for real GPT responses
   OPENAI_PROJECT_ID   - optional (use when key is sk-proj-...)
+  MAX_UPLOAD_MB       - optional, largest request body accepted by /solve (default 40)
+  MAX_FILES           - optional, most images per /solve call (default 10)
 """
 
 import os
-import json
-import base64
+import re
+import asyncio
 import traceback
+from collections import OrderedDict
 from typing import List
 
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Request, HTTPException
+from fastapi.responses import HTMLResponse, ORJSONResponse
 
-# Prefer modern OpenAI client
+from mcq_core import content_key, image_data_url, make_async_client, lru_get, lru_put, try_parse_json_candidate
+
+# Prefer modern OpenAI client (async, pooled HTTP/2)
 try:
-    from openai import OpenAI as OpenAIClient
+    from openai import AsyncOpenAI
     MODERN_OPENAI = True
 except Exception:
-    OpenAIClient = None
+    AsyncOpenAI = None
     MODERN_OPENAI = False
 
 # Fallback to legacy 'openai' (best-effort) — optional
@@ -37,7 +42,24 @@ except Exception:
     legacy_openai = None
     LEGACY_OPENAI = False
 
-app = FastAPI(title="GPT Multi-Image Solver (sync)")
+app = FastAPI(title="GPT Multi-Image Solver (sync)", default_response_class=ORJSONResponse)
+
+# --- Upload limits ---
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "40")) * 1024 * 1024
+MAX_FILES = int(os.getenv("MAX_FILES", "10"))
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # runs before FastAPI parses the multipart body, so an oversized upload is refused
+    # from its Content-Length without a byte of it being spooled to disk
+    if request.method == "POST":
+        try:
+            size = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            size = 0
+        if size > MAX_UPLOAD_BYTES:
+            return ORJSONResponse({"detail": f"Upload larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"}, status_code=413)
+    return await call_next(request)
 
 # --- OpenAI config (from env) ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -47,14 +69,13 @@ OPENAI_PROJECT_ID = os.getenv("OPENAI_PROJECT_ID")
 if not OPENAI_API_KEY:
     print("Warning: OPENAI_API_KEY not set — server will return simulated responses for testing.")
 
-# Create client (modern preferred)
+# Create client (modern preferred); one instance for the process so every
+# request reuses the same warm connection pool
 def make_client():
     if not OPENAI_API_KEY:
         return None
     if MODERN_OPENAI:
-        if OPENAI_PROJECT_ID:
-            return OpenAIClient(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT_ID)
-        return OpenAIClient(api_key=OPENAI_API_KEY)
+        return make_async_client(OPENAI_API_KEY, OPENAI_PROJECT_ID)
     if LEGACY_OPENAI:
         legacy_openai.api_key = OPENAI_API_KEY
         return legacy_openai
@@ -62,6 +83,12 @@ def make_client():
 
 client = make_client()
 
+# Stream the reply and return as soon as the answer letter is out, without waiting
+# for the explanation tokens (EARLY_ANSWER=0 waits for the full JSON instead)
+EARLY_ANSWER = os.getenv("EARLY_ANSWER", "1") == "1"
+_OPTION_RE = re.compile(r'"correct_option"\s*:\s*"([A-E])"')
+_STATUS_RE = re.compile(r'"status"\s*:\s*"(ok|unclear|confused)"')
+
 SYSTEM_PROMPT = """
 You are an OCR + reasoning assistant for multi-image MCQ questions.
 Each image may contain part of the question (text, diagram, or options).
@@ -77,15 +104,23 @@ If image is blurry → status=\"unclear\".
 If more than one answer possible → status=\"confused\".
 """
 
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+USER_PREAMBLE = {"type": "text", "text": "These images together form one MCQ (question + options). Read and answer with the correct option (A/B/C/D/E)."}
+_LEGACY_USER_MSG = {"role": "user", "content": "These images together form one MCQ. Answer with JSON."}
+
+# ---- Response cache: BLAKE3 of all image bytes (mcq_core.content_key) -> parsed answer (LRU, "ok" answers only) ----
+CACHE_SIZE = 4096
+CACHE = OrderedDict()
+_KEY_LOCKS = {}  # cache key -> [asyncio.Lock held while that upload is being solved, holders + waiters]
+
 # -------------------- ROUTES --------------------
 
 @app.get("/")
 def home():
     return {"message": "✅ GPT Multi-Image Solver API (Production) Active"}
 
-@app.get("/test", response_class=HTMLResponse)
-def upload_form():
-    html = """
+# rendered once at import; every GET /test sends the same response object
+_UPLOAD_HTML = HTMLResponse(content="""
     <html>
     <head>
     <title>🧠 GPT Multi-Image Solver Test</title>
@@ -119,75 +154,116 @@ def upload_form():
         <br>
         <input type="submit" value="Upload & Solve" style="padding: 8px 16px;">
       </form>
-      <p style="color:gray;">Note: This server calls OpenAI synchronously — request will wait for the model response.</p>
+      <p style="color:gray;">Note: This server calls OpenAI directly — request will wait for the model response.</p>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html)
+    """)
 
+@app.get("/test", response_class=HTMLResponse)
+def upload_form():
+    return _UPLOAD_HTML
 
-@app.post("/solve")
-async def solve(files: List[UploadFile] = File(...)):
-    # Basic validation
-    if not files or len(files) == 0:
-        return JSONResponse({"status": "unclear", "correct_option": None, "explanation": "No images received."})
 
+async def solve_uncached(files: List[UploadFile]):
+    # -> (answer dict, cacheable); only a parsed model answer is cacheable, early ones included
     # Build image payloads as data URLs (base64). Keep them simple for multimodal client.
-    imgs = []
-    for f in files:
-        try:
-            data = await f.read()
-            b64 = base64.b64encode(data).decode()
-            imgs.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
-            })
-        except Exception as e:
-            return JSONResponse({"status": "unclear", "correct_option": None, "explanation": f"Failed to read image: {e}"})
-
-    # If no OpenAI configured -> return simulated quick response for testing
-    if client is None:
-        return JSONResponse({"status": "ok", "correct_option": "A", "explanation": "Simulated (OPENAI_API_KEY not configured)."})
+    # Each image is downscaled + encoded in its own thread (Pillow and pybase64 release the GIL),
+    # so a multi-image upload takes as long as its largest image, not the sum of all of them
+    try:
+        urls = await asyncio.gather(*[asyncio.to_thread(image_data_url, f.file, f.content_type) for f in files])
+    except Exception as e:
+        return {"status": "unclear", "correct_option": None, "explanation": f"Failed to read image: {e}"}, False
+    imgs = [{"type": "image_url", "image_url": {"url": url}} for url in urls]
 
     # Build the messages for the model
-    system_msg = {"role": "system", "content": SYSTEM_PROMPT}
-    user_payload = [{"type": "text", "text": "These images together form one MCQ (question + options). Read and answer with the correct option (A/B/C/D/E)."}] + imgs
+    user_payload = [USER_PREAMBLE, *imgs]
 
     try:
-        # Modern client path (OpenAIClient) — best-effort attempt to access response text
+        # Modern client path (AsyncOpenAI) — best-effort attempt to access response text
         if MODERN_OPENAI:
-            resp = client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 model="gpt-4o",  # change to model you have access to (gpt-4o-mini, gpt-4o, etc.)
-                messages=[system_msg, {"role": "user", "content": user_payload}],
+                messages=[SYSTEM_MSG, {"role": "user", "content": user_payload}],
                 max_tokens=300,
-                temperature=0
+                temperature=0,
+                response_format={"type": "json_object"},  # no fences or prose around the JSON
+                stream=True
             )
-            # Try to read standard fields; this may vary with SDK versions — fallback to string
+            parts = []
             try:
-                raw = resp.choices[0].message.content.strip()
-            except Exception:
-                raw = str(resp)
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    if EARLY_ANSWER and '"' in delta:
+                        text = "".join(parts)
+                        m = _OPTION_RE.search(text)
+                        st = _STATUS_RE.search(text) if m else None
+                        if st:
+                            return {"status": st.group(1), "correct_option": m.group(1), "explanation": None}, True
+            finally:
+                # stops generation and hands the connection back to the pool
+                await stream.close()
+            raw = "".join(parts).strip()
 
         # Legacy openai package path
         else:
-            resp = client.ChatCompletion.create(
+            resp = await client.ChatCompletion.acreate(
                 model="gpt-4o",
-                messages=[system_msg, {"role": "user", "content": "These images together form one MCQ. Answer with JSON."}],
+                messages=[SYSTEM_MSG, _LEGACY_USER_MSG],
                 max_tokens=300,
                 temperature=0
             )
             raw = resp["choices"][0]["message"]["content"].strip()
 
-        # Try to parse JSON output
-        try:
-            parsed = json.loads(raw)
-            # Ensure keys exist
-            return JSONResponse(parsed)
-        except Exception:
-            # If model didn't return JSON, return a structured fallback
-            return JSONResponse({"status": "confused", "correct_option": None, "explanation": raw})
+        # Try to parse JSON output (bare, fenced or surrounded by prose)
+        parsed = try_parse_json_candidate(raw)
+        if parsed is not None:
+            return parsed, True
+        # If model didn't return JSON, return a structured fallback
+        return {"status": "confused", "correct_option": None, "explanation": raw}, False
 
     except Exception as e:
         # Return the error in JSON; keep trace for debugging (not recommended in prod or public)
         tb = traceback.format_exc()
-        return JSONResponse({"status": "unclear", "correct_option": None, "explanation": f"OpenAI error: {str(e)}", "trace": tb})
+        return {"status": "unclear", "correct_option": None, "explanation": f"OpenAI error: {str(e)}", "trace": tb}, False
+
+
+@app.post("/solve")
+async def solve(files: List[UploadFile] = File(...)):
+    # Basic validation
+    if not files or len(files) == 0:
+        return ORJSONResponse({"status": "unclear", "correct_option": None, "explanation": "No images received."})
+    if len(files) > MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_FILES} images per question")
+
+    # If no OpenAI configured -> return simulated quick response for testing (no hashing or encoding)
+    if client is None:
+        return ORJSONResponse({"status": "ok", "correct_option": "A", "explanation": "Simulated (OPENAI_API_KEY not configured)."})
+
+    # identical uploads (retries, resubmits, shared practice sets) skip encode and the model call
+    key = await asyncio.to_thread(content_key, [f.file for f in files])
+    cached = lru_get(CACHE, key)
+    if cached is not None:
+        return ORJSONResponse(cached)
+
+    # concurrent duplicates wait for the first one instead of each calling the model
+    entry = _KEY_LOCKS.get(key)
+    if entry is None:
+        entry = _KEY_LOCKS[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            cached = lru_get(CACHE, key)
+            if cached is not None:
+                return ORJSONResponse(cached)
+            result, cacheable = await solve_uncached(files)
+            if cacheable and isinstance(result, dict) and result.get("status") == "ok":
+                lru_put(CACHE, key, result, CACHE_SIZE)
+            return ORJSONResponse(result)
+    finally:
+        # drop the lock only once nobody holds or waits on it
+        entry[1] -= 1
+        if not entry[1]:
+            _KEY_LOCKS.pop(key, None)